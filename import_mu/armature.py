@@ -20,6 +20,7 @@
 # <pep8 compliant>
 
 import bpy
+import numpy as np
 from mathutils import Vector, Quaternion, Matrix
 from ..utils import create_data_object
 
@@ -29,28 +30,44 @@ Matrix_YZ = Matrix(((1,0,0,0),
                     (0,0,1,0),
                     (0,1,0,0),
                     (0,0,0,1)))
+_Y_AXIS = Vector((0, BONE_LENGTH, 0))
+_Z_AXIS = Vector((0, 0, 1))
+# head, tail and roll points of a bone in bone space, one per column
+_BONE_POINTS = np.array(((0, 0, 0, 1),
+                         (0, BONE_LENGTH, 0, 1),
+                         (0, 0, 1, 1))).T
 
 def create_vertex_groups(obj, bones, weights):
     mesh = obj.data
     for bone in bones:
         obj.vertex_groups.new(name=bone)
-    for vind, weight in enumerate(weights):
-        for i in range(4):
-            bind, bweight = weight.indices[i], weight.weights[i]
-            if bweight != 0:
-                obj.vertex_groups[bind].add((vind,), bweight, 'ADD')
+    # vertex_groups.add takes a list of vertices sharing one weight, so
+    # bucket the vertices by (bone, weight) to add them in bulk
+    indices = np.array([w.indices for w in weights]).reshape(-1, 4)
+    bweights = np.array([w.weights for w in weights]).reshape(-1, 4)
+    # skip unused (zero weight) influences with a mask rather than a test
+    # per influence
+    vinds, slots = np.nonzero(bweights)
+    groups = {}
+    for vind, bind, bweight in zip(vinds.tolist(),
+                                   indices[vinds, slots].tolist(),
+                                   bweights[vinds, slots].tolist()):
+        groups.setdefault((bind, bweight), []).append(vind)
+    for (bind, bweight), vinds in groups.items():
+        obj.vertex_groups[bind].add(vinds, bweight, 'ADD')
+
+def _add_armature_modifier(obj, name, armature):
+    mod = obj.modifiers.new(name=name, type='ARMATURE')
+    mod.use_apply_on_spline = False
+    mod.use_bone_envelopes = False
+    mod.use_deform_preserve_volume = False # silly Unity :P
+    mod.use_multi_modifier = False
+    mod.use_vertex_groups = True
+    mod.object = armature
 
 def create_armature_modifier(obj, armobj):
-    def add_modifier(obj, name, armature):
-        mod = obj.modifiers.new(name=name, type='ARMATURE')
-        mod.use_apply_on_spline = False
-        mod.use_bone_envelopes = False
-        mod.use_deform_preserve_volume = False # silly Unity :P
-        mod.use_multi_modifier = False
-        mod.use_vertex_groups = True
-        mod.object = armature
-    add_modifier(obj, "BindPose", armobj.bindPose_obj)
-    add_modifier(obj, "Armature", armobj.armature_obj)
+    _add_armature_modifier(obj, "BindPose", armobj.bindPose_obj)
+    _add_armature_modifier(obj, "Armature", armobj.armature_obj)
 
 def parent_to_bone(child, armature, bone):
     child.parent = armature
@@ -65,58 +82,50 @@ def create_bone(bone_obj, edit_bones):
     # the hierarchy
     bone.head = Vector((0, 0, 0))
     bone.tail = bone.head + Vector((0, BONE_LENGTH, 0))
-    bone.use_connect = False
-    bone.use_inherit_rotation = True
-    bone.use_envelope_multiply = False
-    bone.use_deform = True
-    bone.use_inherit_scale = True
+    # new edit bones are already unconnected, deforming and inherit rotation
+    # and scale, so only the flags that differ from the defaults are set
     bone.use_local_location = False
-    bone.use_relative_parent = False
     bone.use_cyclic_offset = False
     return bone
 
 def process_armature(armobj, rootBones):
-    def process_bone(obj, position, rotation):
-        obj.bone.head = rotation @ Vector(obj.position) + position
-        rot = Quaternion(obj.rotation)
-        lrot = rotation @ rot
-        y = BONE_LENGTH
-        obj.bone.tail = obj.bone.head + lrot @ Vector((0, y, 0))
-        obj.bone.align_roll(lrot @ Vector((0, 0, 1)))
-        for child in obj.children:
-            if hasattr(child, "armature") and child.armature == armobj:
-                process_bone(child, obj.bone.head, lrot)
+    #the armature object has no bone
+    pos = Vector((0, 0, 0))
+    rot = Quaternion((1, 0, 0, 0))
+    stack = [(rootBone, pos, rot) for rootBone in rootBones]
+    while stack:
+        obj, position, rotation = stack.pop()
+        # position and rotation are already mathutils types (see
+        # create_armature), so no need to copy them
+        bone = obj.bone
+        head = rotation @ obj.position + position
+        bone.head = head
+        lrot = rotation @ obj.rotation
+        bone.tail = head + lrot @ _Y_AXIS
+        bone.align_roll(lrot @ _Z_AXIS)
+        stack.extend((child, head, lrot) for child in obj.children
+                     if getattr(child, "armature", None) is armobj)
         # must not keep references to bones when the armature leaves edit mode,
         # so keep the bone's name instead (which is what's needed for bone
         # parenting anway)
-        obj.bone = obj.bone.name
-
-    pos = Vector((0, 0, 0))
-    rot = Quaternion((1, 0, 0, 0))
-    #the armature object has no bone
-    for rootBone in rootBones:
-        process_bone(rootBone, pos, rot)
+        obj.bone = bone.name
 
 def find_bones(mu, skin, siblings):
-    bone_names = set(skin.skinned_mesh_renderer.bones)
-    for i, bname in enumerate(skin.skinned_mesh_renderer.bones):
-        bone = mu.objects[bname]
-        bp = skin.skinned_mesh_renderer.mesh.bindPoses[i]
-        bp = Matrix((bp[0:4], bp[4:8], bp[8:12], bp[12:16]))
-        bone.bindPose = Matrix_YZ @ bp @ Matrix_YZ
+    smr = skin.skinned_mesh_renderer
+    skin_bones = [mu.objects[bname] for bname in smr.bones]
+    # keep the raw (Unity space, flat row-major) bind poses: they are only
+    # needed for the batched conversion in create_armature
+    for bone, bp in zip(skin_bones, smr.mesh.bindPoses):
+        bone.bindPose = bp
+    # walk up from each bone to the skin's siblings, stopping early if the
+    # rest of the chain has already been found
     bones = set()
-    for bname in bone_names:
-        bones.add(mu.objects[bname])
-
-    prev_bones = set()
-    while bones - prev_bones:
-        prev_bones = bones
-        bones = set()
-        for b in prev_bones:
+    for b in skin_bones:
+        while b not in bones:
             bones.add(b)
-            while b not in siblings:
-                b = b.parent
-                bones.add(b)
+            if b in siblings:
+                break
+            b = b.parent
     #print(list(map(lambda b: b.transform.name, bones)))
 
     return bones
@@ -145,56 +154,67 @@ def create_armature(mu, skins, siblings):
     armobj.bindPose_obj.parent = armobj.armature_obj
 
     ctx = bpy.context
-    # link armature objects so they can be edited
-    ctx.layer_collection.collection.objects.link(armobj.armature_obj)
-    ctx.layer_collection.collection.objects.link(armobj.bindPose_obj)
+    # link armature objects so they can be edited (edit mode needs the
+    # objects to be in the view layer)
+    ctx_objects = ctx.layer_collection.collection.objects
+    ctx_objects.link(armobj.armature_obj)
+    ctx_objects.link(armobj.bindPose_obj)
 
+    mode_set = bpy.ops.object.mode_set
     save_active = ctx.view_layer.objects.active
+
+    # each armature gets exactly one edit session: all bones are created and
+    # parented before going back to object mode
     ctx.view_layer.objects.active = armobj.armature_obj
-    bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+    mode_set(mode='EDIT', toggle=False)
+    edit_bones = armobj.armature.edit_bones
+    r_inv = armobj.rotation.inverted()
+    armobj_pos = armobj.position
     for b in bones:
         b.position = Vector(b.transform.localPosition)
         b.rotation = Quaternion(b.transform.localRotation)
         b.relRotation = Quaternion((1, 0, 0, 0))
         if b in siblings:
-            r = armobj.rotation.inverted()
-            b.rotation = r @ b.rotation
-            b.position = r @ (b.position - armobj.position)
-            b.relRotation = r
+            b.rotation = r_inv @ b.rotation
+            b.position = r_inv @ (b.position - armobj_pos)
+            b.relRotation = r_inv
         b.armature = armobj
-        b.bone = create_bone(b, armobj.armature.edit_bones)
+        b.bone = create_bone(b, edit_bones)
     for b in bones:
         if b.parent in bones:
             b.bone.parent = b.parent.bone
         else:
             rootBones.add(b)
-        b.force_import = False
-        for c in b.children:
-            if c not in bones:
-                b.force_import = True
+        # stop at the first child that isn't a bone
+        b.force_import = any(c not in bones for c in b.children)
     process_armature(armobj, rootBones)
-    bpy.ops.object.mode_set(mode='OBJECT')
+    mode_set(mode='OBJECT')
 
     ctx.view_layer.objects.active = armobj.bindPose_obj
-    bpy.ops.object.mode_set(mode='EDIT', toggle=False)
-    for b in bones:
-        if hasattr(b, "bindPose"):
-            m = b.bindPose.inverted()
-            pb = create_bone (b, armobj.bindPose.edit_bones)
-            pb.head = m @ Vector((0, 0, 0))
-            pb.tail = m @ Vector((0, BONE_LENGTH, 0))
-            pb.align_roll(m @ Vector((0, 0, 1)))
-            b.poseBone = pb.name
-    bpy.ops.object.mode_set(mode='OBJECT')
-    for b in bones:
-        if hasattr(b, "bindPose"):
-            pb = armobj.bindPose_obj.pose.bones[b.poseBone]
-            rb = armobj.armature_obj.pose.bones[b.poseBone]
-            pb.matrix = rb.matrix
+    mode_set(mode='EDIT', toggle=False)
+    bindPose_edit = armobj.bindPose.edit_bones
+    pose_bones = [b for b in bones if hasattr(b, "bindPose")]
+    # convert all the bind poses to blender space, invert them and transform
+    # the bone points in one go. Matrix_YZ is a permutation, so
+    # Matrix_YZ @ bp @ Matrix_YZ just swaps rows 1,2 and columns 1,2
+    bindPoses = np.array([b.bindPose for b in pose_bones]).reshape(-1, 4, 4)
+    bindPoses = bindPoses[:, [0, 2, 1, 3]][:, :, [0, 2, 1, 3]]
+    points = np.linalg.inv(bindPoses) @ _BONE_POINTS
+    for b, p in zip(pose_bones, points):
+        pb = create_bone(b, bindPose_edit)
+        pb.head = Vector(p[:3, 0])
+        pb.tail = Vector(p[:3, 1])
+        pb.align_roll(Vector(p[:3, 2]))
+        b.poseBone = pb.name
+    mode_set(mode='OBJECT')
+    for b in pose_bones:
+        pb = armobj.bindPose_obj.pose.bones[b.poseBone]
+        rb = armobj.armature_obj.pose.bones[b.poseBone]
+        pb.matrix = rb.matrix
 
     # don't clutter the main collection if importing to a different collection
-    ctx.layer_collection.collection.objects.unlink(armobj.armature_obj)
-    ctx.layer_collection.collection.objects.unlink(armobj.bindPose_obj)
+    ctx_objects.unlink(armobj.armature_obj)
+    ctx_objects.unlink(armobj.bindPose_obj)
     ctx.view_layer.objects.active = save_active
     #however, do need to link the bindPose armature to the import collection
     mu.collection.objects.link(armobj.bindPose_obj)